@@ -1,7 +1,18 @@
-import utils, json, asyncio, scraper, models, evaluate, db, os, random
+import utils, json, asyncio, scraper, models, evaluate, db, cache, os, random, weakref
 from typing import AsyncGenerator, List, Any, Optional, Dict
 from fastapi import HTTPException
-from pydantic import BaseModel, HttpUrl
+from pydantic import BaseModel, HttpUrl, ValidationError
+from datetime import datetime, timedelta
+
+# Seconds a stored analysis is reused for the same URL (0 disables the cache)
+CACHE_TTL = int(os.getenv("CACHE_TTL", "86400"))
+# Seconds a single model's evaluation is reused for the same article text; longer than CACHE_TTL,
+# so a re-analysis after the stored result expires only calls the models it has no evaluation from
+EVAL_CACHE_TTL = int(os.getenv("EVAL_CACHE_TTL", "604800"))
+
+# Model lists are JSON arrays in the environment; parse them once
+SUMMARY_MODEL = json.loads(os.getenv("SUMMARY_MODEL") or "[]")
+EVALUATION_MODELS = json.loads(os.getenv("EVALUATION_MODELS") or "[]")
 
 class Summary(BaseModel):
     summary: str
@@ -70,15 +81,143 @@ class AnalyzeResponse(BaseModel):
     consensus: ConsensusResponse
     history: Optional[Dict[str, Any]]
 
+SUMMARY_PROMPT = '''
+You are a news analyst. Analyze the provided news article and produce a structured JSON object with three fields: summary, topics, and type.
+
+Instructions:
+
+- summary: Write a 2-4 sentence summary capturing the key facts or conclusions of the article. Use neutral and concise language.
+- topics: Provide a list of 1-3 broad topics (e.g., “Climate Change”, “Elections”, “Technology”). Each topic must start with a capital letter.
+- type: Classify the article as either "Opinion" or "Reporting".
+- Opinion = subjective commentary, argument, or editorial tone.
+- Reporting = fact-based news, analysis, or investigative content.
+
+Output format (JSON only):
+
+{
+    "summary": "",
+    "topics": [],
+    "type": ""
+}
+
+Return only valid JSON — no markdown, explanations, or extra text.  No cleaning should be required (i.e., no "```json" at the start and "```" at the end).
+'''
+
+# Built once at import; only the article payload is appended per request
+SUMMARY_PROMPT_PREFIX = SUMMARY_PROMPT + "\n---\n"
+
+SUMMARY_SCHEMA = Summary.model_json_schema()
+EVALUATION_SCHEMA = Evaluation.model_json_schema()
+CONSENSUS_SCHEMA = Consensus.model_json_schema()
+
+def is_fresh(row) -> bool:
+    return bool(row) and datetime.now() - row[1] < timedelta(seconds=CACHE_TTL)
+
+def replay_events(final_result: AnalyzeResponse):
+    """The (event, data) sequence the live pipeline emits, rebuilt from a stored result."""
+    yield "status", {"message": "Evaluating article..."}
+    for evaluation in final_result.evaluations:
+        yield "evaluation", evaluation.model_dump()
+    yield "status", {"message": "Finding consensus..."}
+    yield "status", {"message": "Getting historical data..."}
+    yield "done", final_result.model_dump()
+
+async def cached_event_stream(final_result: AnalyzeResponse) -> AsyncGenerator[str, None]:
+    # Emit the whole cached run in one burst so clients see the same events as a live run
+    for event, data in replay_events(final_result):
+        yield utils.sse_event(event, data)
+
+def build_evaluation(r) -> Optional[dict]:
+    """Turn the outcome of one evaluation call into a ModelEvaluation dict, or None if the call failed or returned no valid evaluation."""
+    if isinstance(r, Exception):
+        print(f"⚠️ Evaluation call failed: {r}")
+        return None
+
+    try:
+        parsed = Evaluation.model_validate_json(r["text"]).model_dump()
+    except ValidationError:
+        print(f"⚠️ Invalid evaluation from {r.get('model')}: {r.get('error') or r['text'][:200]}")
+        return None
+
+    return {
+        "model": r.get("model"),
+        "article": parsed["article"],
+        "publication": parsed["publication"],
+        "raw": parsed,
+    }
+
+def require_evaluations(evaluations: List[dict]):
+    if not evaluations:
+        raise HTTPException(status_code=502, detail="None of the models returned a usable evaluation — please try again.")
+
+async def cached_evaluation(model: str, evaluation: str) -> dict:
+    return {"model": model, "text": evaluation}
+
+async def evaluate_pair(prompt: str, pair: tuple, eval_key: str) -> dict:
+    """Evaluate with one model pair and store a valid result for reuse on the same article text."""
+    r = await models.call_openrouter(prompt, EVALUATION_SCHEMA, model=pair)
+    try:
+        evaluation = Evaluation.model_validate_json(r["text"])
+    except (ValidationError, TypeError, KeyError):
+        return r
+    await asyncio.to_thread(db.cache_evaluation, eval_key, r["model"], evaluation.model_dump_json())
+    return r
+
+# Analyses currently running, keyed by canonical URL, so identical concurrent requests share one run.
+# Lookups and inserts happen without an await in between, so no lock is needed.
+INFLIGHT: Dict[str, asyncio.Future] = {}
+
+def settle(key: str, future: asyncio.Future, result: Optional[AnalyzeResponse] = None, error: Optional[BaseException] = None):
+    """Resolve an in-flight analysis for the requests waiting on it and release its URL."""
+    if INFLIGHT.get(key) is future:
+        del INFLIGHT[key]
+    if future.done():
+        return
+    if error is None:
+        future.set_result(result)
+        return
+    if not isinstance(error, Exception):
+        # Cancelled or abandoned stream: waiters get a retryable error instead
+        error = HTTPException(status_code=503, detail="Analysis of this URL was interrupted — please try again.")
+    future.set_exception(error)
+    future.exception()  # nobody may be waiting; don't log it as never retrieved
+
 # ---- Shared function ----
 async def run_analysis(req, stream: bool = False) -> dict | AsyncGenerator[str, None]:
+    # Fetch the URL as given; the canonical form only keys the caches and in-flight runs
     url = str(req.url)
+    key = utils.canonicalize_url(url)
 
     # --- 1. Quick pre-check ---
     if not utils.looks_like_article_url(url):
         raise HTTPException(status_code=400, detail="This link doesn't appear to be a news article URL.")
 
-    # --- 2. Scrape article ---
+    # --- 2. Reuse a recent result for the same URL ---
+    cached = await asyncio.to_thread(db.get_latest_result, key) if CACHE_TTL > 0 else None
+    if is_fresh(cached):
+        final_result = AnalyzeResponse.model_validate_json(cached[0]).model_copy(update={"url": HttpUrl(url)})
+        if stream:
+            return cached_event_stream(final_result)
+        return final_result
+
+    # --- 3. Join an identical analysis that is already running ---
+    pending = INFLIGHT.get(key)
+    if pending is not None:
+        final_result = (await asyncio.shield(pending)).model_copy(update={"url": HttpUrl(url)})
+        if stream:
+            return cached_event_stream(final_result)
+        return final_result
+
+    future = asyncio.get_running_loop().create_future()
+    INFLIGHT[key] = future
+    try:
+        return await analyze_article(req, url, key, future, stream)
+    except BaseException as e:
+        settle(key, future, error=e)
+        raise
+
+async def analyze_article(req, url: str, key: str, future: asyncio.Future, stream: bool) -> AnalyzeResponse | AsyncGenerator[str, None]:
+    # --- 4. Scrape article ---
     try:
         scraped = await scraper.scrape_article(url)
     except Exception as e:
@@ -88,11 +227,25 @@ async def run_analysis(req, stream: bool = False) -> dict | AsyncGenerator[str,
     title = scraped.get("title") or ""
     publication = scraped.get("publication") or ""
 
-    if len(text.strip()) < 500:
+    if len(text.strip()) < scraper.MIN_ARTICLE_CHARS:
         raise HTTPException(status_code=400, detail="Extracted content is too short — likely not a full article.")
     if not title or len(title.strip()) < 5:
         raise HTTPException(status_code=400, detail="No valid title detected — likely not a news article.")
 
+    # --- 5. Reuse a recent result for the same article text at another URL of the same outlet (AMP, mirrors) ---
+    content_hash = utils.content_hash(text)
+    cached = await asyncio.to_thread(db.get_result_by_content_hash, content_hash, publication) if CACHE_TTL > 0 else None
+    if is_fresh(cached):
+        # The analysis carries over; the URL, title and history are this page's own
+        history = await db.get_consensus_stats_for_url(key)
+        final_result = AnalyzeResponse.model_validate_json(cached[0]).model_copy(
+            update={"url": HttpUrl(url), "title": title, "history": history}
+        )
+        settle(key, future, final_result)
+        if stream:
+            return cached_event_stream(final_result)
+        return final_result
+
     metadata = {
         "title": title,
         "authors": scraped.get("authors"),
@@ -102,185 +255,107 @@ async def run_analysis(req, stream: bool = False) -> dict | AsyncGenerator[str,
         "content": text[:req.max_summary_chars],
     }
 
-    SUMMARY_MODEL = os.getenv("SUMMARY_MODEL")
-
-    SUMMARY_PROMPT = '''
-    You are a news analyst. Analyze the provided news article and produce a structured JSON object with three fields: summary, topics, and type.
-
-    Instructions:
-
-    - summary: Write a 2-4 sentence summary capturing the key facts or conclusions of the article. Use neutral and concise language.
-    - topics: Provide a list of 1-3 broad topics (e.g., “Climate Change”, “Elections”, “Technology”). Each topic must start with a capital letter.
-    - type: Classify the article as either "Opinion" or "Reporting".
-    - Opinion = subjective commentary, argument, or editorial tone.
-    - Reporting = fact-based news, analysis, or investigative content.
+    p = SUMMARY_PROMPT_PREFIX + utils.dumps_pretty({
+            "title": title,
+            "authors": metadata["authors"],
+            "publication": publication,
+            "url": url,
+            "content_snippet": metadata["content"],
+        })
 
-    Output format (JSON only):
+    # result = await models.call_ollama(p, SUMMARY_SCHEMA, SUMMARY_MODEL)
+    result = await cache.call_openrouter(p, SUMMARY_SCHEMA, SUMMARY_MODEL, Summary)
+    summary = Summary.model_validate_json(result["text"])
 
-    {
-        "summary": "",
-        "topics": [],
-        "type": ""
-    }
+    # Fields were just validated on Summary; don't dump and validate them again
+    summary_response = SummaryResponse.model_construct(**dict(summary), model=result["model"])
 
-    Return only valid JSON — no markdown, explanations, or extra text.  No cleaning should be required (i.e., no "```json" at the start and "```" at the end).
-    '''
-
-    p = SUMMARY_PROMPT + "\n---\n" + json.dumps({
-            "title": metadata.get("title"),
-            "authors": metadata.get("authors"),
-            "publication": metadata.get("publication"),
-            "url": metadata.get("url"),
-            "content_snippet": metadata.get("content")[:req.max_summary_chars]
-        }, ensure_ascii=False, indent=2)
-
-    # result = await models.call_ollama(p, Summary.model_json_schema(), SUMMARY_MODEL)
-    result = await models.call_openrouter(p, Summary.model_json_schema(), json.loads(SUMMARY_MODEL))
-    text = Summary.model_validate_json(result['text'])
-
-    # If LLM returned a structured model, convert it cleanly
-    if hasattr(text, "model_dump"):
-        parsed = text.model_dump()
-    elif isinstance(text, dict):
-        parsed = text
-    else:
-        # fallback if something goes wrong
-        try:
-            parsed = json.loads(text)
-        except Exception:
-            parsed = {}
-
-    summary_response = SummaryResponse(
-        summary=parsed.get("summary", {}),
-        topics=parsed.get("topics", {}),
-        type=parsed.get("type", {}),
-        model=result["model"]
-    )
-
-    # --- 3. Make evaluations ---
+    # --- 6. Make evaluations ---
     prompt = evaluate.make_evaluation_prompt(metadata)
 
-    model_list = json.loads(os.getenv("EVALUATION_MODELS"))
-
+    model_list = EVALUATION_MODELS.copy()
     random.shuffle(model_list)
     pairs = [(model_list[i], model_list[i + 1]) for i in range(0, min(len(model_list), 6), 2)]
     pairs = pairs[:3]
 
+    # Reuse evaluations of this article text by any model of a pair; only call the rest.
+    # The evaluation's publication block depends on the outlet, so the key covers it too.
+    eval_key = utils.content_hash(f"{publication}\n{text}")
+    model_names = [model for pair in pairs for model in pair]
+    cached = await asyncio.to_thread(db.get_cached_evaluations, eval_key, model_names, EVAL_CACHE_TTL) if EVAL_CACHE_TTL > 0 else {}
+
     calls = []
+    # Reused evaluations are already counted in result_evaluations under an earlier result
+    reused_models = []
 
     for pair in pairs:
-        calls.append(models.call_openrouter(prompt, Evaluation.model_json_schema(), model=pair))
+        hit = next((model for model in pair if model in cached), None)
+        if hit:
+            calls.append(cached_evaluation(hit, cached.pop(hit)))
+            reused_models.append(hit)
+        else:
+            calls.append(evaluate_pair(prompt, pair, eval_key))
 
     # --- Streaming branch ---
     async def event_stream():
-        yield utils.sse_event("status", {"message": "Evaluating article..."})
-        raw_results = await asyncio.gather(*calls, return_exceptions=True)
-
-        evaluations = []
-        for r in raw_results:
-            if isinstance(r, Exception):
-                ev = {
-                    "model": "error",
-                    "article": {
-                        "bias": "Unknown",
-                        "credibility": "Unknown",
-                        "notes": f"Model call failed: {r}",
-                    },
-                    "publication": {"source_of_funding": None, "location": None},
-                    "raw": None,
-                }
-                evaluations.append(ev)
-                yield utils.sse_event("evaluation", evaluation)
-                continue
-
-            text = r.get("text")
-
-            # If LLM returned a structured model, convert it cleanly
-            if hasattr(text, "model_dump"):
-                parsed = text.model_dump()
-            elif isinstance(text, dict):
-                parsed = text
-            else:
-                # fallback if something goes wrong
+        try:
+            yield utils.sse_event("status", {"message": "Evaluating article..."})
+
+            # Emit each evaluation as soon as its model responds
+            evaluations = []
+            for call in asyncio.as_completed(calls):
                 try:
-                    parsed = json.loads(text)
-                except Exception:
-                    parsed = {}
-            
-            if not isinstance(parsed, dict):
-                parsed = json.loads(json.dumps(parsed, default=str))
-
-            evaluation = {
-                "model": r.get("model"),
-                "article": parsed.get("article", {}),
-                "publication": parsed.get("publication", {}),
-                "raw": {"text": parsed, "normalized": parsed},
-            }
-            evaluations.append(evaluation)
-            yield utils.sse_event("evaluation", evaluation)
-
-        yield utils.sse_event("status", {"message": "Finding consensus..."})
-        consensus = await evaluate.aggregate_evaluations(evaluations, metadata)
-
-        yield utils.sse_event("status", {"message": "Getting historical data..."})
-        history = await db.get_consensus_stats_for_url(url)
-
-        final_result = AnalyzeResponse(
-            url = url,
-            title = metadata.get("title"),
-            authors = metadata.get("authors"),
-            publication = metadata.get("publication"),
-            published_at = str(metadata.get("published_at")),
-            summary=summary_response,
-            evaluations = evaluations,
-            consensus = consensus,
-            history = history,
-        )
+                    r = await call
+                except Exception as e:
+                    r = e
+
+                # Failed calls are left out rather than sent as evaluations that don't fit the schema
+                evaluation = build_evaluation(r)
+                if evaluation is not None:
+                    evaluations.append(evaluation)
+                    yield utils.sse_event("evaluation", evaluation)
+            require_evaluations(evaluations)
+
+            yield utils.sse_event("status", {"message": "Finding consensus..."})
+            consensus = await evaluate.aggregate_evaluations(evaluations, metadata)
+
+            yield utils.sse_event("status", {"message": "Getting historical data..."})
+            history = await db.get_consensus_stats_for_url(key)
+
+            final_result = AnalyzeResponse(
+                url = url,
+                title = metadata.get("title"),
+                authors = metadata.get("authors"),
+                publication = metadata.get("publication"),
+                published_at = str(metadata.get("published_at")),
+                summary=summary_response,
+                evaluations = evaluations,
+                consensus = consensus,
+                history = history,
+            )
         
-        db.insert_result(url, metadata.get("publication"), final_result.model_dump_json())
+            await asyncio.to_thread(db.insert_result, key, metadata.get("publication"), final_result, content_hash, reused_models)
+            settle(key, future, final_result)
 
-        yield utils.sse_event("done", final_result.model_dump())
+            yield utils.sse_event("done", final_result.model_dump())
+        except BaseException as e:
+            settle(key, future, error=e)
+            raise
 
     if stream:
-        return event_stream()
+        stream_gen = event_stream()
+        # Release waiters even if the response is dropped before the stream starts
+        weakref.finalize(stream_gen, settle, key, future, None, GeneratorExit())
+        return stream_gen
 
     # --- Non-streaming branch ---
     raw_results = await asyncio.gather(*calls, return_exceptions=True)
-    evaluations = []
-    for r in raw_results:
-        if isinstance(r, Exception):
-            evaluations.append({
-                "model": "error",
-                "article": {"bias": "Unknown", "credibility": "Unknown", "notes": f"Model call failed: {r}"},
-                "publication": {"source_of_funding": None, "location": None},
-                "raw": None,
-            })
-            continue
-
-        text = r.get("text")
-
-        # If LLM returned a structured model, convert it cleanly
-        if hasattr(text, "model_dump"):
-            parsed = text.model_dump()
-        elif isinstance(text, dict):
-            parsed = text
-        else:
-            # fallback if something goes wrong
-            try:
-                parsed = json.loads(text)
-            except Exception:
-                parsed = {}
-
-        evaluations.append({
-            "model": r.get("model"),
-            "article": parsed.get("article", {}),
-            "publication": parsed.get("publication", {}),
-            "raw": {"text": parsed, "normalized": parsed},
-        })
+    evaluations = [e for e in map(build_evaluation, raw_results) if e is not None]
+    require_evaluations(evaluations)
 
     consensus = await evaluate.aggregate_evaluations(evaluations, metadata)
 
-    history = await db.get_consensus_stats_for_url(url)
+    history = await db.get_consensus_stats_for_url(key)
 
     final_result = AnalyzeResponse(
             url = url,
@@ -294,6 +369,7 @@ async def run_analysis(req, stream: bool = False) -> dict | AsyncGenerator[str,
             history = history,
         )
     
-    db.insert_result(url, metadata.get("publication"), final_result.model_dump_json())
+    await asyncio.to_thread(db.insert_result, key, metadata.get("publication"), final_result, content_hash, reused_models)
+    settle(key, future, final_result)
 
-    return final_result
\ No newline at end of file
+    return final_result
@@ -1,7 +1,8 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, HttpUrl
-import models, analysis, db
+import models, analysis, db, scraper
 from typing import Optional
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
@@ -11,7 +12,18 @@ from slowapi.errors import RateLimitExceeded
 
 load_dotenv()
 
-app = FastAPI(title="News Evaluator Prototype")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Pooled HTTP/2 clients shared by every OpenRouter call and every article fetch
+    async with models.new_http_client() as client, scraper.new_http_client() as scrape_client:
+        models.HTTP = client
+        scraper.HTTP = scrape_client
+        try:
+            yield
+        finally:
+            await scraper.close_browser()
+
+app = FastAPI(title="News Evaluator Prototype", lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -47,20 +59,17 @@ async def analyze_stream(req: AnalyzeRequest, request: Request):
 @app.get("/charts")
 @limiter.limit("20/minute")
 def get_charts(request: Request):
-    charts = {}
-
-    # Common grouping keys
+    # Common grouping keys (columns of the evaluations below)
     groupings = {
-        "by_model": "json_extract_string(value, '$.model')",
+        "by_model": "model",
         "by_publication": "publication",  # use top-level column
     }
 
-    # Define chart categories: field name + display order
+    # Define chart categories: evaluation column + display order
     chart_categories = {
         "fairness": {
-            "json_path": "$.article.fairness",
             "order_case": """
-                CASE json_extract_string(value, '$.article.fairness')
+                CASE metric
                     WHEN 'Low' THEN 1
                     WHEN 'Medium' THEN 2
                     WHEN 'High' THEN 3
@@ -69,9 +78,8 @@ def get_charts(request: Request):
             """,
         },
         "headline_article": {
-            "json_path": "$.article.headline_article",
             "order_case": """
-                CASE json_extract_string(value, '$.article.headline_article')
+                CASE metric
                     WHEN 'Low' THEN 1
                     WHEN 'Medium' THEN 2
                     WHEN 'High' THEN 3
@@ -81,30 +89,42 @@ def get_charts(request: Request):
         },
     }
 
-    for category, cfg in chart_categories.items():
-        charts[category] = {}
-
-        for group_by, key_expr in groupings.items():
-            query = f"""
-            SELECT
-                json_extract_string(value, '{cfg["json_path"]}') AS metric,
-                {key_expr} AS key,
-                COUNT(*) AS count
-            FROM results,
-                 json_each(json_extract(result, '$.evaluations'))
-            WHERE json_extract_string(value, '{cfg["json_path"]}') IS NOT NULL
-            GROUP BY
-                json_extract_string(value, '{cfg["json_path"]}'),
-                {key_expr}
-            ORDER BY
-                {cfg["order_case"]},
-                {key_expr};
-            """
+    # Join the stored evaluations to their publication once, then count every category/grouping pair from it
+    subqueries = [
+        f"""
+        SELECT
+            '{category}' AS category,
+            '{group_by}' AS group_by,
+            metric,
+            key,
+            COUNT(*) AS count,
+            {cfg["order_case"]} AS metric_order
+        FROM (SELECT {category} AS metric, {key_column} AS key FROM evaluations)
+        WHERE metric IS NOT NULL
+        GROUP BY metric, key
+        """
+        for category, cfg in chart_categories.items()
+        for group_by, key_column in groupings.items()
+    ]
+    query = f"""
+    WITH evaluations AS MATERIALIZED (
+        SELECT r.publication, e.model, {", ".join(f"e.{category}" for category in chart_categories)}
+        FROM result_evaluations e
+        JOIN results r ON r.id = e.result_id
+    )
+    SELECT category, group_by, metric, key, count
+    FROM ({" UNION ALL ".join(subqueries)})
+    ORDER BY category, group_by, metric_order, key;
+    """
 
-            rows = db.chart_query(query)
-            charts[category][group_by] = db.transform_for_chart(rows)
+    grouped = {category: {group_by: [] for group_by in groupings} for category in chart_categories}
+    for row in db.chart_query(query):
+        grouped[row.pop("category")][row.pop("group_by")].append(row)
 
-    return charts
+    return {
+        category: {group_by: db.transform_for_chart(rows) for group_by, rows in by_group.items()}
+        for category, by_group in grouped.items()
+    }
 
 
 @app.get('/health')
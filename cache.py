@@ -0,0 +1,35 @@
+import asyncio, hashlib, os, orjson, models, db
+from typing import Optional, Type
+from pydantic import BaseModel, ValidationError
+from datetime import datetime, timedelta
+
+# How long a stored LLM reply is reused for an identical prompt; 0 disables the cache
+CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 604800))
+
+def prompt_hash(prompt: str, model) -> str:
+    return hashlib.blake2b(orjson.dumps([prompt, model]), digest_size=16).hexdigest()
+
+async def call_openrouter(prompt: str, format: dict, model: list[str], response_model: Optional[Type[BaseModel]] = None) -> dict:
+    """
+    models.call_openrouter, but an identical prompt to the same models reuses the stored reply.
+    With response_model, only replies that validate against it are stored.
+    """
+    if CACHE_TTL <= 0:
+        return await models.call_openrouter(prompt, format, model)
+
+    key = prompt_hash(prompt, model)
+    cached = await asyncio.to_thread(db.get_cached_completion, key)
+    if cached and datetime.now() - cached[2] < timedelta(seconds=CACHE_TTL):
+        return {"model": cached[1], "text": cached[0], "raw": None}
+
+    result = await models.call_openrouter(prompt, format, model)
+    if result["model"] == "error":
+        return result
+    if response_model is not None:
+        try:
+            response_model.model_validate_json(result["text"])
+        except ValidationError:
+            return result
+
+    await asyncio.to_thread(db.cache_completion, key, result["text"], result["model"])
+    return result
@@ -1,7 +1,9 @@
-import duckdb, os, json, models, utils
-from collections import Counter
-from typing import List, Dict, Any
-from pydantic import BaseModel, RootModel
+import duckdb, os, json, asyncio, hashlib, threading, orjson, zstandard, models, utils
+from collections import Counter, defaultdict
+from operator import itemgetter
+from datetime import datetime, timedelta
+from typing import List, Dict, Any, Optional
+from pydantic import BaseModel, RootModel, ValidationError
 
 class StatsAnswer(BaseModel):
     answer: str
@@ -12,168 +14,375 @@ class FieldStats(RootModel[Dict[str, List[StatsAnswer]]]):
 
 class Deduplication(BaseModel):
     stats: List[FieldStats]
-    
-
-CONSENSUS_FIELDS = [
-    "perspective",
-    "tone_language",
-    "fairness",
-    "headline_article",
-    "source_of_funding",
-    "ownership",
-    "location",
-]
+
+# Slim view of a stored AnalyzeResponse: just the fields that feed the stats columns
+class StoredArticle(BaseModel):
+    perspective: Optional[str] = None
+    tone_language: Optional[List[str]] = None
+    fairness: Optional[str] = None
+    headline_article: Optional[str] = None
+
+class StoredPublication(BaseModel):
+    source_of_funding: Optional[List[str]] = None
+    ownership: Optional[str] = None
+    location: Optional[str] = None
+
+class StoredEvaluation(BaseModel):
+    model: Optional[str] = None
+    article: StoredArticle = StoredArticle()
+    publication: StoredPublication = StoredPublication()
+
+class StoredResult(BaseModel):
+    consensus: StoredEvaluation = StoredEvaluation()
+    evaluations: List[StoredEvaluation] = []
+
+# Stats field -> (section of a consensus/evaluation object, DuckDB column type).
+# Each is stored in its own column so stats and charts never parse the result JSON.
+CONSENSUS_FIELDS = {
+    "perspective": ("article", "TEXT"),
+    "tone_language": ("article", "TEXT[]"),
+    "fairness": ("article", "TEXT"),
+    "headline_article": ("article", "TEXT"),
+    "source_of_funding": ("publication", "TEXT[]"),
+    "ownership": ("publication", "TEXT"),
+    "location": ("publication", "TEXT"),
+}
+
+LIST_FIELDS = {field for field, (_, column_type) in CONSENSUS_FIELDS.items() if column_type.endswith("[]")}
+
+CONSENSUS_STATS_SELECT = """
+SELECT 'consensus' AS kind, '{field}' AS field, {outcome} AS answer, COUNT(*) AS count
+FROM matched
+WHERE consensus_{field} IS NOT NULL
+GROUP BY ALL"""
+
+ANSWER_STATS_SELECT = """
+SELECT 'answer' AS kind, '{field}' AS field, answer, COUNT(*) AS count
+FROM (SELECT {answer} AS answer FROM evaluations)
+WHERE answer IS NOT NULL
+GROUP BY ALL"""
+
+# Tallies, per field, consensus vs "No Consensus" outcomes and every individual
+# evaluation answer (list answers are unnested) for one URL in a single query
+STATS_QUERY = """
+WITH matched AS (
+    SELECT * FROM results WHERE url = $url
+),
+evaluations AS (
+    SELECT e.* FROM result_evaluations e JOIN matched m ON e.result_id = m.id
+)""" + "\nUNION ALL".join(
+    [
+        CONSENSUS_STATS_SELECT.format(
+            field=field,
+            outcome="'yes'" if field in LIST_FIELDS
+            else f"CASE WHEN lower(consensus_{field}) = 'no consensus' THEN 'no' ELSE 'yes' END",
+        )
+        for field in CONSENSUS_FIELDS
+    ] + [
+        ANSWER_STATS_SELECT.format(field=field, answer=f"unnest({field})" if field in LIST_FIELDS else field)
+        for field in CONSENSUS_FIELDS
+    ]
+) + "\nORDER BY count DESC, answer"
+
+DEDUPLICATION_PROMPT = '''
+You are a text analysis system.
+
+The provided stats object contains multiple fields: perspective, tone_language, fairness, headline_article, source_of_funding, ownership, and location.
+
+Each field includes an answers list of text strings (and their counts). Your task is to group semantically or stylistically equivalent answers within each field and produce canonical labels with combined counts.
+
+Grouping Rules
+
+1. Normalize for comparison:
+- Convert to lowercase
+- Trim whitespace
+- Remove punctuation except internal hyphens (-)
+- Collapse multiple spaces into one
+2. Merge answers if they are effectively equivalent — for example:
+- Same meaning with minor wording differences (e.g., "Pro-Palestinian" ≈ "Pro Palestinian self-determination")
+- Differ only in capitalization or punctuation (e.g., "Government of Qatar" ≈ "Government Of Qatar")
+3. When merging, use the most representative or commonly occurring form as the canonical label (capitalize each major word).
+4. The count for a canonical label is the sum of counts from all merged variants.
+5. Preserve the order of fields as listed above.
+6. Return "Unknown" if a field has no valid answers.
+
+Output Schema
+
+Return only a valid JSON object in this exact structure (no markdown, code fences, or explanations):
+
+{
+    "stats": [
+        { "perspective": [ { "answer": "", "count": 0 } ] },
+        { "tone_language": [ { "answer": "", "count": 0 } ] },
+        { "fairness": [ { "answer": "", "count": 0 } ] },
+        { "headline_article": [ { "answer": "", "count": 0 } ] },
+        { "source_of_funding": [ { "answer": "", "count": 0 } ] },
+        { "ownership": [ { "answer": "", "count": 0 } ] },
+        { "location": [ { "answer": "", "count": 0 } ] }
+    ]
+}
+
+Each list can contain multiple { "answer": "<canonical label>", "count": <combined count> } objects.
+
+Return only this JSON — no extra text or commentary. No cleaning should be required (i.e., no "```json" at the start and "```" at the end).
+'''
+
+# Built once at import; only the stats payload is appended per request
+DEDUPLICATION_PROMPT_PREFIX = DEDUPLICATION_PROMPT + "\n---\nAnswers:\n"
+
+DEDUPLICATION_SCHEMA = Deduplication.model_json_schema()
 
 DB_PATH = "file.db"
 
-SUMMARY_MODEL = os.getenv("SUMMARY_MODEL")
+SUMMARY_MODEL = json.loads(os.getenv("SUMMARY_MODEL") or "[]")
 
-con = duckdb.connect("file.db")
-con.sql("CREATE SEQUENCE id_seq START 1")
-con.sql(
-    "CREATE TABLE results (id INTEGER PRIMARY KEY DEFAULT nextval('id_seq'), url TEXT, publication TEXT, result JSON, date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+# One connection for the process; each call works on its own cursor
+_CON = duckdb.connect(DB_PATH)
+_CON.sql("CREATE SEQUENCE IF NOT EXISTS id_seq START 1")
+_CON.sql(
+    "CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY DEFAULT nextval('id_seq'), url TEXT, publication TEXT, result JSON, date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+    )
+_CON.sql("ALTER TABLE results ADD COLUMN IF NOT EXISTS content_hash TEXT")
+# Full AnalyzeResponse JSON, zstd-compressed; replaces the uncompressed result column
+_CON.sql("ALTER TABLE results ADD COLUMN IF NOT EXISTS result_zstd BLOB")
+for field, (_, column_type) in CONSENSUS_FIELDS.items():
+    _CON.sql(f"ALTER TABLE results ADD COLUMN IF NOT EXISTS consensus_{field} {column_type}")
+# Set once backfill_stats_columns has looked at a row, so rows it can't fill aren't retried every start
+_CON.sql("ALTER TABLE results ADD COLUMN IF NOT EXISTS stats_backfilled BOOLEAN")
+_CON.sql(
+    "CREATE TABLE IF NOT EXISTS result_evaluations (result_id INTEGER, model TEXT, "
+    + ", ".join(f"{field} {column_type}" for field, (_, column_type) in CONSENSUS_FIELDS.items())
+    + ")"
     )
+_CON.sql("CREATE INDEX IF NOT EXISTS idx_result_evaluations_result_id ON result_evaluations(result_id)")
+_CON.sql("CREATE INDEX IF NOT EXISTS idx_results_url ON results(url)")
+_CON.sql("CREATE INDEX IF NOT EXISTS idx_results_publication ON results(publication)")
+_CON.sql("CREATE INDEX IF NOT EXISTS idx_results_content_hash ON results(content_hash)")
+_CON.sql("CREATE TABLE IF NOT EXISTS dedup_cache (stats_hash TEXT PRIMARY KEY, result JSON, model TEXT)")
+_CON.sql("CREATE TABLE IF NOT EXISTS eval_cache (content_hash TEXT, model TEXT, evaluation JSON, date TIMESTAMP DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (content_hash, model))")
+# No default: rows cached before the column existed get NULL and count as expired
+_CON.sql("ALTER TABLE eval_cache ADD COLUMN IF NOT EXISTS date TIMESTAMP")
+_CON.sql("CREATE TABLE IF NOT EXISTS llm_cache (prompt_hash TEXT PRIMARY KEY, text TEXT, model TEXT, date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
 
 # con.sql("CREATE SEQUENCE articles_id_seq START 1")
 # con.sql(
 #     "CREATE TABLE articles (id INTEGER PRIMARY KEY DEFAULT nextval('articles_id_seq'), url TEXT, result JSON, date TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
 #     )
 
-def insert_result(url: str, publication: str, result: str):
-    con = duckdb.connect(DB_PATH)
-    con.sql(
-        'INSERT INTO results (url, publication, result) VALUES ($url, $publication, $result)',
-        params={'url': url, 'publication': publication, 'result': result}
-    )
-    con.close()
-
-async def get_consensus_stats_for_url(url: str):
-    con = duckdb.connect(DB_PATH)
-    rows = con.execute("SELECT result FROM results WHERE url = ?", [url]).fetchall()
-    con.close()
-    if not rows:
-        return {"url": url, "stats": {}}
-
-    field_values = {field: [] for field in CONSENSUS_FIELDS}
+# zstd contexts are not thread-safe and DB calls run in worker threads, so keep one per thread
+_ZSTD = threading.local()
+
+def compress_result(result_json: str) -> bytes:
+    if not hasattr(_ZSTD, "cctx"):
+        _ZSTD.cctx = zstandard.ZstdCompressor(level=3)
+    return _ZSTD.cctx.compress(result_json.encode())
+
+def decompress_result(row):
+    """Turn a (result_zstd, result, date) row into (result JSON, date); rows written before compression keep result."""
+    if row is None:
+        return None
+    blob, legacy_json, date = row
+    if blob is None:
+        return legacy_json, date
+    if not hasattr(_ZSTD, "dctx"):
+        _ZSTD.dctx = zstandard.ZstdDecompressor()
+    return _ZSTD.dctx.decompress(blob).decode(), date
+
+def field_values(evaluation) -> List[Any]:
+    """The CONSENSUS_FIELDS values, in order, of a consensus or model evaluation."""
+    return [getattr(getattr(evaluation, section), field) for field, (section, _) in CONSENSUS_FIELDS.items()]
+
+CONSENSUS_COLUMNS = ", ".join(f"consensus_{field}" for field in CONSENSUS_FIELDS)
+FIELD_PARAMS = ", ".join("?" for _ in CONSENSUS_FIELDS)
+
+def insert_evaluation_rows(cur, result_id: int, evaluations):
+    if evaluations:
+        cur.executemany(
+            f"INSERT INTO result_evaluations VALUES (?, ?, {FIELD_PARAMS})",
+            [[result_id, ev.model, *field_values(ev)] for ev in evaluations]
+        )
+
+def insert_result(url: str, publication: str, result, content_hash: str = None, reused_models: List[str] = ()):
+    """Store an AnalyzeResponse: the full JSON plus its consensus and evaluation fields as columns.
+    Evaluations by reused_models came from eval_cache and already have rows, so they aren't added again."""
+    with _CON.cursor() as cur:
+        cur.begin()
+        (result_id,) = cur.execute(
+            f"INSERT INTO results (url, publication, result_zstd, content_hash, {CONSENSUS_COLUMNS}) "
+            f"VALUES (?, ?, ?, ?, {FIELD_PARAMS}) RETURNING id",
+            [url, publication, compress_result(result.model_dump_json()), content_hash, *field_values(result.consensus)]
+        ).fetchone()
+        insert_evaluation_rows(cur, result_id, [ev for ev in result.evaluations if ev.model not in reused_models])
+        cur.commit()
+
+def backfill_stats_columns():
+    """
+    Fill the stats columns of results stored before they existed. Those rows only
+    carry the result JSON (possibly compressed), so SQL can't reach the fields and
+    each one is parsed with the slim StoredResult model instead.
+    """
+    with _CON.cursor() as cur:
+        rows = cur.execute(
+            "SELECT id, result_zstd, result, date FROM results r "
+            "WHERE stats_backfilled IS NULL "
+            "AND NOT EXISTS (SELECT 1 FROM result_evaluations e WHERE e.result_id = r.id) AND "
+            + " AND ".join(f"consensus_{field} IS NULL" for field in CONSENSUS_FIELDS)
+        ).fetchall()
+        if not rows:
+            return
+
+        cur.begin()
+        for result_id, *stored in rows:
+            result_json, _ = decompress_result(stored)
+            if result_json is None:
+                continue
+            try:
+                record = StoredResult.model_validate_json(result_json)
+            except ValidationError as e:
+                print(f"⚠️ Failed to parse record {result_id}: {e}")
+                continue
+
+            cur.execute(
+                f"UPDATE results SET ({CONSENSUS_COLUMNS}) = ({FIELD_PARAMS}) WHERE id = ?",
+                [*field_values(record.consensus), result_id]
+            )
+            insert_evaluation_rows(cur, result_id, record.evaluations)
+
+        # Including the ones that failed to parse or hold only NULL fields
+        cur.execute(
+            "UPDATE results SET stats_backfilled = true WHERE list_contains(?, id)",
+            [[result_id for result_id, *_ in rows]]
+        )
+        cur.commit()
+
+backfill_stats_columns()
+
+def get_latest_result(url: str):
+    """Return the most recent (result, date) row stored for a URL, or None."""
+    with _CON.cursor() as cur:
+        return decompress_result(cur.execute(
+            "SELECT result_zstd, result, date FROM results WHERE url = ? ORDER BY date DESC LIMIT 1", [url]
+        ).fetchone())
+
+def get_result_by_content_hash(content_hash: str, publication: str):
+    """Return the most recent (result, date) row stored for the same article text from the same publication, or None."""
+    with _CON.cursor() as cur:
+        return decompress_result(cur.execute(
+            "SELECT result_zstd, result, date FROM results WHERE content_hash = ? AND publication = ? ORDER BY date DESC LIMIT 1",
+            [content_hash, publication]
+        ).fetchone())
+
+def get_cached_evaluations(content_hash: str, model_names: List[str], max_age: int) -> Dict[str, str]:
+    """Return {model: evaluation JSON} for evaluations stored under content_hash by any of model_names, at most max_age seconds old."""
+    with _CON.cursor() as cur:
+        rows = cur.execute(
+            "SELECT model, evaluation FROM eval_cache WHERE content_hash = ? AND list_contains(?, model) AND date > ?",
+            [content_hash, model_names, datetime.now() - timedelta(seconds=max_age)]
+        ).fetchall()
+    return dict(rows)
+
+def cache_evaluation(content_hash: str, model: str, evaluation: str):
+    # Best-effort: mirrors of one article analyzed at once can write the same key concurrently,
+    # which DuckDB may reject as a conflict even with OR REPLACE
+    try:
+        with _CON.cursor() as cur:
+            cur.execute(
+                "INSERT OR REPLACE INTO eval_cache (content_hash, model, evaluation, date) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+                [content_hash, model, evaluation]
+            )
+    except duckdb.Error as e:
+        print(f"⚠️ Failed to cache evaluation by {model}: {e}")
+
+def get_cached_deduplication(stats_hash: str):
+    """Return the (result, model) of a previous deduplication of identical stats, or None."""
+    with _CON.cursor() as cur:
+        return cur.execute(
+            "SELECT result, model FROM dedup_cache WHERE stats_hash = ?", [stats_hash]
+        ).fetchone()
+
+def cache_deduplication(stats_hash: str, result: str, model: str):
+    # Best-effort: a concurrent writer of the same stats can make DuckDB raise a conflict
+    try:
+        with _CON.cursor() as cur:
+            cur.execute(
+                "INSERT OR IGNORE INTO dedup_cache (stats_hash, result, model) VALUES (?, ?, ?)",
+                [stats_hash, result, model]
+            )
+    except duckdb.Error as e:
+        print(f"⚠️ Failed to cache deduplication {stats_hash}: {e}")
+
+def get_cached_completion(prompt_hash: str):
+    """Return the (text, model, date) of a stored reply to an identical prompt, or None."""
+    with _CON.cursor() as cur:
+        return cur.execute(
+            "SELECT text, model, date FROM llm_cache WHERE prompt_hash = ?", [prompt_hash]
+        ).fetchone()
+
+def cache_completion(prompt_hash: str, text: str, model: str):
+    # Stamp the date explicitly: OR REPLACE keeps the old row's date otherwise, so an expired entry never freshens.
+    # Best-effort: concurrent writers of one prompt can make DuckDB raise a conflict.
+    try:
+        with _CON.cursor() as cur:
+            cur.execute(
+                "INSERT OR REPLACE INTO llm_cache (prompt_hash, text, model, date) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+                [prompt_hash, text, model]
+            )
+    except duckdb.Error as e:
+        print(f"⚠️ Failed to cache completion {prompt_hash}: {e}")
+
+def compute_consensus_stats(url: str) -> Dict[str, Any]:
+    """Aggregate the stored results for a URL into per-field consensus/answer counts."""
+    with _CON.cursor() as cur:
+        rows = cur.execute(STATS_QUERY, {"url": url}).fetchall()
+
+    consensus_counts = {field: Counter() for field in CONSENSUS_FIELDS}
     field_answers = {field: [] for field in CONSENSUS_FIELDS}
-
-    for (result_json,) in rows:
-        try:
-            data = json.loads(result_json)
-            consensus = data.get("consensus", {})
-            article = consensus.get("article", {})
-            publication = consensus.get("publication", {})
-
-            mapping = {
-                "perspective": article.get("perspective"),
-                "tone_language": article.get("tone_language"),
-                "fairness": article.get("fairness"),
-                "headline_article": article.get("headline_article"),
-                "source_of_funding": publication.get("source_of_funding"),
-                "ownership": publication.get("ownership"),
-                "location": publication.get("location"),
-            }
-
-            # Track consensus values
-            for field, value in mapping.items():
-                if value is not None:
-                    field_values[field].append(value)
-
-            for ev in data.get("evaluations", []):
-                article = ev.get("article", {})
-                publication = ev.get("publication", {})
-                mapping = {
-                    "perspective": article.get("perspective"),
-                    "tone_language": article.get("tone_language"),
-                    "fairness": article.get("fairness"),
-                    "headline_article": article.get("headline_article"),
-                    "source_of_funding": publication.get("source_of_funding"),
-                    "ownership": publication.get("ownership"),
-                    "location": publication.get("location"),
-                }
-                for field, answer in mapping.items():
-                    if answer is None:
-                        continue
-                    if isinstance(answer, list):
-                        field_answers[field].extend(answer)
-                    else:
-                        field_answers[field].append(answer)
-
-        except Exception as e:
-            print(f"⚠️ Failed to parse record: {e}")
+    for kind, field, answer, count in rows:
+        if kind == "consensus":
+            consensus_counts[field][answer] = count
+        else:
+            field_answers[field].append({"answer": answer, "count": count})
 
     # ---- Compute stats
     stats = {}
-    for field, values in field_values.items():
-        if not values:
-            continue
-
-        counts = Counter(["no" if str(v).lower() == "no consensus" else "yes" for v in values])
+    for field, counts in consensus_counts.items():
         total = sum(counts.values())
-        no_ratio = (counts["no"] / total) * 100
-        yes_ratio = (counts["yes"] / total) * 100
-
-        answer_counts = Counter(field_answers[field])
-        answers_list = [{"answer": ans, "count": count} for ans, count in answer_counts.items()]
+        if not total:
+            continue
 
         stats[field] = {
-            "no_consensus": round(no_ratio, 1),
-            "consensus": round(yes_ratio, 1),
+            "no_consensus": round(counts["no"] / total * 100, 1),
+            "consensus": round(counts["yes"] / total * 100, 1),
             "total": total,
-            "answers": answers_list,
+            "answers": field_answers[field],
         }
 
-    # ---- Deduplication step (single LLM call)
-    DEDUPLICATION_PROMPT = '''
-    You are a text analysis system.
-
-    The provided stats object contains multiple fields: perspective, tone_language, fairness, headline_article, source_of_funding, ownership, and location.
-
-    Each field includes an answers list of text strings (and their counts). Your task is to group semantically or stylistically equivalent answers within each field and produce canonical labels with combined counts.
-
-    Grouping Rules
+    return stats
 
-    1. Normalize for comparison:
-    - Convert to lowercase
-    - Trim whitespace
-    - Remove punctuation except internal hyphens (-)
-    - Collapse multiple spaces into one
-    2. Merge answers if they are effectively equivalent — for example:
-    - Same meaning with minor wording differences (e.g., "Pro-Palestinian" ≈ "Pro Palestinian self-determination")
-    - Differ only in capitalization or punctuation (e.g., "Government of Qatar" ≈ "Government Of Qatar")
-    3. When merging, use the most representative or commonly occurring form as the canonical label (capitalize each major word).
-    4. The count for a canonical label is the sum of counts from all merged variants.
-    5. Preserve the order of fields as listed above.
-    6. Return "Unknown" if a field has no valid answers.
-
-    Output Schema
-
-    Return only a valid JSON object in this exact structure (no markdown, code fences, or explanations):
-
-    {
-        "stats": [
-            { "perspective": [ { "answer": "", "count": 0 } ] },
-            { "tone_language": [ { "answer": "", "count": 0 } ] },
-            { "fairness": [ { "answer": "", "count": 0 } ] },
-            { "headline_article": [ { "answer": "", "count": 0 } ] },
-            { "source_of_funding": [ { "answer": "", "count": 0 } ] },
-            { "ownership": [ { "answer": "", "count": 0 } ] },
-            { "location": [ { "answer": "", "count": 0 } ] }
-        ]
-    }
-
-    Each list can contain multiple { "answer": "<canonical label>", "count": <combined count> } objects.
-
-    Return only this JSON — no extra text or commentary. No cleaning should be required (i.e., no "```json" at the start and "```" at the end).
-    '''
+async def get_consensus_stats_for_url(url: str):
+    stats = await asyncio.to_thread(compute_consensus_stats, url)
+    if not stats:
+        return {"url": url, "stats": {}}
 
-    prompt = DEDUPLICATION_PROMPT + "\n---\nAnswers:\n" + json.dumps(stats, indent=2)
+    # Nothing to merge when no field has more than one distinct answer
+    if all(len(field_stats["answers"]) <= 1 for field_stats in stats.values()):
+        return {"url": url, "stats": stats}
 
-    result = await models.call_openrouter(prompt, Deduplication.model_json_schema(), json.loads(SUMMARY_MODEL))
+    # ---- Deduplication step (single LLM call, reused while the stats are unchanged)
+    stats_hash = hashlib.sha256(orjson.dumps(stats, option=orjson.OPT_SORT_KEYS)).hexdigest()
+    cached = await asyncio.to_thread(get_cached_deduplication, stats_hash)
+    if cached:
+        result = {"text": cached[0], "model": cached[1]}
+    else:
+        prompt = DEDUPLICATION_PROMPT_PREFIX + utils.dumps_pretty(stats)
+        result = await models.call_openrouter(prompt, DEDUPLICATION_SCHEMA, SUMMARY_MODEL)
 
     text = Deduplication.model_validate_json(result["text"])
     parsed = text.model_dump()
 
+    if not cached:
+        await asyncio.to_thread(cache_deduplication, stats_hash, result["text"], result["model"])
+
     # flatten the nested structure
     stats_data = parsed.get("stats", [])
     deduped_map = {k: v for field_obj in stats_data for k, v in field_obj.items()}
@@ -191,10 +400,10 @@ async def get_consensus_stats_for_url(url: str):
 
 # --- Utility to run query --- #
 def chart_query(query: str) -> List[Dict[str, Any]]:
-    with duckdb.connect(DB_PATH, read_only=True) as conn:
-        conn.execute(query)
-        rows = conn.fetchall()
-        cols = [desc[0] for desc in conn.description]
+    with _CON.cursor() as cur:
+        cur.execute(query)
+        rows = cur.fetchall()
+        cols = [desc[0] for desc in cur.description]
         return [dict(zip(cols, row)) for row in rows]
 
 
@@ -215,17 +424,14 @@ def transform_for_chart(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         return []
 
     # Detect the x-axis field (first key not named 'key' or 'count')
-    sample = rows[0]
-    x_field = next((k for k in sample.keys() if k not in {"key", "count"}), None)
+    x_field = next((k for k in rows[0] if k not in ("key", "count")), None)
     if not x_field:
         return []
 
-    grouped: Dict[str, List[Dict[str, Any]]] = {}
+    get_x, get_key, get_count = itemgetter(x_field), itemgetter("key"), itemgetter("count")
+    grouped: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
     for row in rows:
-        x_value = row[x_field]
-        key = row["key"]
-        count = row["count"]
-        grouped.setdefault(x_value, []).append({"key": key, "count": count})
+        grouped[get_x(row)].append({"key": get_key(row), "count": get_count(row)})
 
     # Return standardized structure
     return [{"x": x, "y": ylist} for x, ylist in grouped.items()]
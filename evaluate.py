@@ -1,11 +1,14 @@
-import models, utils, json, os, analysis
+import cache, utils, orjson, os, analysis
 from typing import List, Dict, Any
+from pydantic import ValidationError
 from dotenv import load_dotenv
 
 
 load_dotenv()
 
 CONSENSUS_MODEL = os.getenv("CONSENSUS_MODEL")
+# Fallback model list for the consensus call, parsed once; the env value is fixed for the process
+CONSENSUS_MODELS = orjson.loads(CONSENSUS_MODEL) if CONSENSUS_MODEL else []
 
 EVALUATION_RUBRIC = '''
 You are an expert news analyst. Your goal is to help users understand the context, bias, and perspective of a news article — not to verify truth or accuracy. Provide a balanced, analytical assessment in structured JSON format.
@@ -52,15 +55,22 @@ Output Schema
 Return only this JSON structure with completed values. No cleaning should be required (i.e., no "```json" at the start and "```" at the end).
 '''
 
+# Built once at import; only the per-article part is appended per request
+EVALUATION_PROMPT_PREFIX = EVALUATION_RUBRIC + "\n---\n"
+
+# Evaluators only see the start of the article
+SNIPPET_CHARS = 3000
+
 def make_evaluation_prompt(metadata: Dict[str, Any]) -> str:
-    return EVALUATION_RUBRIC + "\n---\n" + json.dumps({
+    content = metadata.get("content") or ""
+    return EVALUATION_PROMPT_PREFIX + utils.dumps_pretty({
         "title": metadata.get("title"),
         "authors": metadata.get("authors"),
         "publication": metadata.get("publication"),
-        "published_at": str(metadata.get("published_at")),
+        "published_at": metadata.get("published_at"),
         "url": metadata.get("url"),
-        "content_snippet": metadata.get("content")[:3000]
-    }, ensure_ascii=False, indent=2)
+        "content_snippet": content[:SNIPPET_CHARS] if len(content) > SNIPPET_CHARS else content
+    })
 
 CONSENSUS_PROMPT = '''
 You are a meta-reviewer of structured news-article evaluations produced by multiple models. Your job is to detect consensus for each field and return a single JSON object with the consensus results, a confidence score (0-1), and any disagreements.
@@ -147,33 +157,47 @@ Notes fields:
 Return only the JSON object described above with filled fields. No cleaning should be required. Don't put ```json at the start and ``` at the end of the object).
 ''' 
 
+CONSENSUS_PROMPT_PREFIX = CONSENSUS_PROMPT + "\n---\nInput evaluations:\n"
+
 async def aggregate_evaluations(evals: List[Dict[str, Any]], metadata: Dict[str, Any]) -> Dict[str, Any]:
+    # Evaluations arrive in completion order; sort them so identical sets give an identical, cacheable prompt
+    evals = sorted(evals, key=lambda e: orjson.dumps(e, option=orjson.OPT_SORT_KEYS))
     payload = {"article": {"title": metadata.get('title'), "url": metadata.get('url')}, "evaluations": evals}
-    prompt = CONSENSUS_PROMPT + "\n---\nInput evaluations:\n" + json.dumps(payload, ensure_ascii=False, indent=2)
+    prompt = CONSENSUS_PROMPT_PREFIX + utils.dumps_pretty(payload)
     
-    resp = await models.call_openrouter(prompt, analysis.Consensus.model_json_schema(), model=json.loads(CONSENSUS_MODEL))
+    resp = await cache.call_openrouter(prompt, analysis.CONSENSUS_SCHEMA, CONSENSUS_MODELS, analysis.Consensus)
 
     raw_text = resp.get("text", "")
-    cleaned_text = utils.clean_llm_json(raw_text)
-
-    if isinstance(cleaned_text, (dict, list)):
-        parsed_json = cleaned_text
-    else:
-        # Try one more time if it’s still a string (some models double-wrap)
-        try:
-            parsed_json = json.loads(cleaned_text)
-        except Exception:
-            parsed_json = {}
 
     try:
-        text = analysis.Consensus.model_validate(parsed_json)
-    except Exception as e:
-        print(f"[WARN] Consensus validation failed, using fallback. Error: {e}")
-        text = analysis.Consensus.model_validate(
-            {"summary": "", "conclusion": "Validation failed", "notes": str(e)}
-        )
+        # The schema-constrained reply is normally clean JSON: parse and validate in one pass
+        text = analysis.Consensus.model_validate_json(raw_text)
+    except ValidationError:
+        text = None
+
+    if text is None:
+        cleaned_text = utils.clean_llm_json(raw_text)
+
+        if isinstance(cleaned_text, (dict, list)):
+            parsed_json = cleaned_text
+        else:
+            # Try one more time if it’s still a string (some models double-wrap)
+            try:
+                parsed_json = orjson.loads(cleaned_text)
+            except Exception:
+                parsed_json = {}
 
-    parsed = text.model_dump() if hasattr(text, "model_dump") else text
+        try:
+            text = analysis.Consensus.model_validate(parsed_json)
+        except Exception as e:
+            print(f"[WARN] Consensus validation failed, using fallback. Error: {e}")
+            text = analysis.Consensus.model_validate({
+                "article": {"perspective": "Unknown", "tone_language": [], "fairness": "Unknown", "headline_article": "Unknown"},
+                "publication": {"source_of_funding": None, "location": None, "ownership": None},
+                "confidence": 0.0,
+                "disagreements": [],
+                "notes": f"Validation failed: {e}",
+            })
 
     # text = analysis.Consensus.model_validate_json(resp['text'])
 
@@ -189,20 +213,13 @@ async def aggregate_evaluations(evals: List[Dict[str, Any]], metadata: Dict[str,
     #     except Exception:
     #         parsed = {}
     
-    if parsed is None:
-        return {
-            "article_bias": evals[0].get('bias') if evals else 'Unknown',
-            "article_credibility": evals[0].get('credibility') if evals else 'Unknown',
-            "confidence": "Meta-LLM failed to return result",
-            "disagreements": [],
-        }
-    
-    consensus = analysis.ConsensusResponse(
-        article=parsed.get("article", {}),
-        publication=parsed.get("publication", {}),
-        confidence=parsed.get("confidence", {}),
-        notes=parsed.get("notes", {}),
-        disagreements=parsed.get("disagreements", {}),
+    # Fields were validated on Consensus above; skip re-validating them
+    consensus = analysis.ConsensusResponse.model_construct(
+        article=text.article,
+        publication=text.publication,
+        confidence=text.confidence,
+        notes=text.notes,
+        disagreements=text.disagreements,
         model = resp["model"],
     )
 
@@ -1,8 +1,8 @@
 # from openai import OpenAI
 # from anthropic import Anthropic
 # from ollama import Client
-import os, utils, asyncio, json, requests
-from typing import List, Dict, Any
+import os, utils, asyncio, json, httpx
+from typing import List, Dict, Any, Optional
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -10,11 +10,25 @@ load_dotenv()
 # OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 # ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 # OLLAMA_API_KEY = os.getenv("OLLAMA_API_KEY")
-# OPENAI_MODEL = os.getenv("OPENAI_MODEL")
-# ANTHROPIC_MODEL = os.getenv("ANTHROPIC_MODEL")
-# OLLAMA_MODEL = os.getenv("OLLAMA_MODEL")
+# Defaults of the direct-provider helpers below; read at import, so they must exist even while those clients are off
+OPENAI_MODEL = os.getenv("OPENAI_MODEL")
+ANTHROPIC_MODEL = os.getenv("ANTHROPIC_MODEL")
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL")
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 
+# Shared keep-alive client for OpenRouter; opened and closed by the app lifespan
+HTTP: Optional[httpx.AsyncClient] = None
+
+# Caps concurrent OpenRouter requests across all analyses to respect provider rate limits
+OPENROUTER_SLOTS = asyncio.Semaphore(int(os.getenv("OPENROUTER_CONCURRENCY", 8)))
+
+def new_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+        timeout=httpx.Timeout(120.0, connect=10.0),
+    )
+
 # openai_client = OpenAI(api_key=OPENAI_API_KEY)
 # anthropic_client = Anthropic(api_key=ANTHROPIC_API_KEY)
 # ollama_client = Client(
@@ -33,7 +47,7 @@ async def call_openai(prompt: str, text_format: Dict, model: str = OPENAI_MODEL,
         )
 
     try:
-        resp = await asyncio.get_event_loop().run_in_executor(None, _call)
+        resp = await asyncio.to_thread(_call)
         text = resp.output_parsed
         return {"model": f"openai:{model}", "text": text, "raw": resp}
     except Exception as e:
@@ -62,7 +76,7 @@ async def call_anthropic(prompt: str, model: str = ANTHROPIC_MODEL, max_tokens:
         )
 
     try:
-        resp = await asyncio.get_event_loop().run_in_executor(None, _call)
+        resp = await asyncio.to_thread(_call)
         text = resp.content[0].text if resp.content else ""
         return {"model": f"anthropic:{model}", "text": text, "raw": resp}
     except Exception as e:
@@ -111,6 +125,11 @@ async def call_ollama(prompt: str, format: Dict, model: str = OLLAMA_MODEL) -> d
         }
 
 async def call_openrouter(prompt: str, format:dict, model: list[str]) -> dict:
+    global HTTP
+    if HTTP is None:
+        # Used outside the app lifespan (e.g. from a script)
+        HTTP = new_http_client()
+
     try:
         url = "https://openrouter.ai/api/v1/completions"
         headers = {
@@ -128,11 +147,14 @@ async def call_openrouter(prompt: str, format:dict, model: list[str]) -> dict:
             }
         }
         # print(payload)
-        response = requests.post(url, headers=headers, json=payload)
-        # print(response.json())
+        async with OPENROUTER_SLOTS:
+            response = await HTTP.post(url, headers=headers, json=payload)
+        data = response.json()
+        # print(data)
 
-        text = response.json()["choices"][0]["text"]
+        text = data["choices"][0]["text"]
         
-        return {"model": response.json()["model"], "text": text, "raw": response.json()}
+        return {"model": data["model"], "text": text, "raw": data}
     except Exception as e:
-        return ("Error:", e)
\ No newline at end of file
+        # Same keys as a success so callers' r["text"] / r["model"] lookups still work
+        return {"model": "error", "text": "", "raw": None, "error": f"OpenRouter call failed: {e}"}
\ No newline at end of file
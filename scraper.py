@@ -1,66 +1,214 @@
-import asyncio, random, nltk, db, httpx
-from typing import Dict, Any, Optional, List
-from newspaper import Article
+import asyncio, random, re, sys, weakref, db, httpx
+from typing import Dict, Any, Optional, List, TypedDict
+from newspaper import Article, Config
+from selectolax.lexbor import LexborHTMLParser, LexborNode
+from urllib.parse import urlparse
 from tenacity import retry, stop_after_attempt, wait_exponential, RetryError
-from pydantic import BaseModel
 from datetime import datetime
 
-class ScraperResponse(BaseModel):
+# Shape of a successful scrape; a plain dict, since newspaper's fields need no validation
+class ScraperResponse(TypedDict):
     title: Optional[str]
     authors: Optional[List[str]]
     publication: Optional[str]
     published_at: Optional[datetime]
     text: Optional[str]
 
-# Ensure NLTK resources
-for resource in ["punkt", "punkt_tab"]:
-    try:
-        nltk.data.find(f"tokenizers/{resource}")
-    except LookupError:
-        nltk.download(resource)
-
 # Browser-like user agents
-USER_AGENTS = [
+USER_AGENTS = (
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0 Safari/537.36",
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 14_5) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15",
     "Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101 Firefox/118.0",
-]
+)
+
+# Sent with every fetch; set once on the shared client
+BASE_HEADERS = {
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.9",
+    "Referer": "https://www.google.com/",
+}
+
+# Shared keep-alive client for article fetches; opened and closed by the app lifespan
+HTTP: Optional[httpx.AsyncClient] = None
+
+def new_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=True,
+        follow_redirects=True,
+        limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+        timeout=20.0,
+        headers=BASE_HEADERS,
+    )
+
+# Built once and only read during parsing, so worker threads can share it. Image fetching
+# is off: parse() would otherwise download images to pick a top image we never use.
+NEWSPAPER_CONFIG = Config()
+NEWSPAPER_CONFIG.fetch_images = False
+
+# Article bodies shorter than this are treated as a failed fast extraction
+# Shortest body text we accept as a full article; analysis rejects anything shorter
+MIN_ARTICLE_CHARS = 500
+
+def meta_content(tree: LexborHTMLParser, selector: str) -> Optional[str]:
+    node = tree.css_first(selector)
+    content = node.attributes.get("content") if node else None
+    return content.strip() if content else None
+
+def parse_date(value: Optional[str]) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+def article_paragraphs(article: LexborNode) -> List[str]:
+    """Paragraphs of an <article>, skipping those inside nested <article> cards."""
+    paragraphs = []
+    for p in article.css("p"):
+        parent = p.parent
+        while parent is not None and parent.tag != "article":
+            parent = parent.parent
+        # Collapse whitespace ourselves: strip=True would glue inline tags to their neighbours
+        text = " ".join(p.text().split())
+        if parent == article and text:
+            paragraphs.append(text)
+    return paragraphs
+
+def extract_with_selectolax(url: str, html: str) -> Optional[ScraperResponse]:
+    """Fast path: pull the fields from common meta tags and <article> paragraphs. None if that comes up short."""
+    tree = LexborHTMLParser(html)
+
+    title = meta_content(tree, 'meta[property="og:title"]')
+    if not title:
+        node = tree.css_first("title")
+        title = node.text(strip=True) if node else None
+
+    # Listing pages wrap teaser cards in <article> too; keep only the one with the most body text
+    bodies = ("\n\n".join(article_paragraphs(node)) for node in tree.css("article"))
+    text = max(bodies, key=len, default="")
+    if not title or len(text) < MIN_ARTICLE_CHARS:
+        return None
+
+    authors = [
+        node.attributes["content"].strip()
+        for node in tree.css('meta[name="author"], meta[property="article:author"]')
+        if node.attributes.get("content") and not node.attributes["content"].startswith("http")
+    ]
+    time_node = tree.css_first("time[datetime]")
+    published_at = parse_date(
+        meta_content(tree, 'meta[property="article:published_time"]')
+        or (time_node.attributes.get("datetime") if time_node else None)
+    )
+    parsed = urlparse(url)
+
+    return ScraperResponse(
+        title=title,
+        authors=list(dict.fromkeys(authors)),
+        publication=f"{parsed.scheme}://{parsed.netloc}" if parsed.netloc else None,
+        published_at=published_at,
+        text=text,
+    )
+
+# A <meta charset> / http-equiv declaration near the top of a page without a header charset
+META_CHARSET = re.compile(rb"""<meta[^>]+charset=["']?([\w-]+)""", re.IGNORECASE)
+
+def decode_html(response: httpx.Response) -> str:
+    """Decode the body once: header charset, else the page's own <meta charset>, else UTF-8."""
+    body = response.content
+    charset = response.charset_encoding
+    if not charset:
+        match = META_CHARSET.search(body, 0, 4096)
+        charset = match.group(1).decode("ascii") if match else "utf-8"
+    try:
+        return body.decode(charset, errors="replace")
+    except LookupError:
+        return body.decode("utf-8", errors="replace")
+
+# Concurrent fetches allowed per host, so a burst of links to one site doesn't trip its rate limiting
+HOST_CONCURRENCY = 2
+# Entries disappear once no fetch holds them
+HOST_SLOTS: "weakref.WeakValueDictionary[str, asyncio.Semaphore]" = weakref.WeakValueDictionary()
+# Extra pause before each fetch from a host that recently answered 429; doubles per 429, halves per success
+HOST_DELAY: Dict[str, float] = {}
+MAX_HOST_DELAY = 30.0
+
+def host_slot(host: str) -> asyncio.Semaphore:
+    slot = HOST_SLOTS.get(host)
+    if slot is None:
+        slot = HOST_SLOTS[host] = asyncio.Semaphore(HOST_CONCURRENCY)
+    return slot
+
+def update_host_delay(host: str, response: httpx.Response):
+    if response.status_code == 429:
+        retry_after = response.headers.get("Retry-After", "")
+        delay = max(HOST_DELAY.get(host, 0.5) * 2, float(retry_after) if retry_after.isdigit() else 0)
+        HOST_DELAY[host] = min(delay, MAX_HOST_DELAY)
+    elif host in HOST_DELAY:
+        delay = HOST_DELAY[host] / 2
+        if delay < 0.5:
+            del HOST_DELAY[host]
+        else:
+            HOST_DELAY[host] = delay
 
 # --- Step 1: Reliable HTTPX fetch with retries ---
 @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=8))
-async def fetch_with_retries(client: httpx.AsyncClient, url: str) -> str:
-    headers = {
-        "User-Agent": random.choice(USER_AGENTS),
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-        "Accept-Language": "en-US,en;q=0.9",
-        "Referer": "https://www.google.com/",
-    }
-    response = await client.get(url, headers=headers, follow_redirects=True)
+async def fetch_with_retries(client: httpx.AsyncClient, url: str, headers: Dict[str, str]) -> str:
+    host = urlparse(url).netloc
+    async with host_slot(host):
+        if host in HOST_DELAY:
+            await asyncio.sleep(HOST_DELAY[host])
+        response = await client.get(url, headers=headers)
+    update_host_delay(host, response)
+
     if response.status_code >= 400:
         raise httpx.HTTPStatusError(
             f"HTTP {response.status_code}",
             request=response.request,
             response=response,
         )
-    return response.text
+    return decode_html(response)
 
 
 # --- Step 2: Playwright fallback for stubborn sites ---
-async def fetch_with_playwright(url: str) -> str:
-    try:
-        import sys
-        from playwright.async_api import async_playwright
+if sys.platform == "win32":
+    asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+# One headless browser, launched on the first fallback and reused; each URL gets its own context
+PLAYWRIGHT = None
+BROWSER = None
+BROWSER_LOCK = asyncio.Lock()
 
-        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+async def get_browser():
+    global PLAYWRIGHT, BROWSER
+    async with BROWSER_LOCK:
+        if BROWSER is None or not BROWSER.is_connected():
+            if PLAYWRIGHT is None:
+                # Imported lazily: most requests never need the fallback
+                from playwright.async_api import async_playwright
+                PLAYWRIGHT = await async_playwright().start()
+            BROWSER = await PLAYWRIGHT.firefox.launch(headless=True)
+    return BROWSER
 
+async def close_browser():
+    global PLAYWRIGHT, BROWSER
+    if BROWSER is not None:
+        await BROWSER.close()
+        BROWSER = None
+    if PLAYWRIGHT is not None:
+        await PLAYWRIGHT.stop()
+        PLAYWRIGHT = None
+
+async def fetch_with_playwright(url: str) -> str:
+    try:
         print(f"⚙️  Falling back to Playwright for {url}")
-        async with async_playwright() as p:
-            browser = await p.firefox.launch(headless=True)
-            page = await browser.new_page()
-            await page.goto(url, wait_until="domcontentloaded", timeout=20000)
-            html = await page.content()
-            await browser.close()
-            return html
+        browser = await get_browser()
+        async with host_slot(urlparse(url).netloc):
+            context = await browser.new_context()
+            try:
+                page = await context.new_page()
+                await page.goto(url, wait_until="domcontentloaded", timeout=20000)
+                return await page.content()
+            finally:
+                await context.close()
 
     except Exception as e:
         raise RuntimeError(f"Playwright fallback failed: {e}")
@@ -68,39 +216,49 @@ async def fetch_with_playwright(url: str) -> str:
 
 # --- Step 3: Main scraper integrating both ---
 async def scrape_article(url: str) -> Dict[str, Any]:
-    async with httpx.AsyncClient(timeout=20.0, follow_redirects=True) as client:
-        try:
-            html = await fetch_with_retries(client, url)
-
-        except RetryError as e:
-            # Extract the final inner exception (e.g. HTTPStatusError)
-            last_exc = e.last_attempt.exception()
-            if isinstance(last_exc, httpx.HTTPStatusError) and last_exc.response.status_code == 403:
-                try:
-                    html = await fetch_with_playwright(url)
-                except Exception as e2:
-                    return {"error": f"Playwright fallback failed: {e2}", "url": url}
-            else:
-                return {
-                    "error": f"Fetch failed after retries: {type(last_exc).__name__}: {last_exc}",
-                    "url": url,
-                }
-
-        except httpx.HTTPStatusError as e:
-            # (Non-retry path, just in case)
-            if e.response.status_code == 403:
-                try:
-                    html = await fetch_with_playwright(url)
-                except Exception as e2:
-                    return {"error": f"Playwright fallback failed: {e2}", "url": url}
-            else:
-                return {"error": f"HTTP {e.response.status_code}: {e.response.reason_phrase}", "url": url}
-
-        except Exception as e:
-            return {"error": f"Unexpected error fetching {url}: {e}"}
+    global HTTP
+    if HTTP is None:
+        # Used outside the app lifespan (e.g. from a script)
+        HTTP = new_http_client()
+
+    try:
+        # One user agent per URL, kept across retries so a 403 reflects the site, not a UA switch
+        html = await fetch_with_retries(HTTP, url, headers={"User-Agent": random.choice(USER_AGENTS)})
+
+    except RetryError as e:
+        # Extract the final inner exception (e.g. HTTPStatusError)
+        last_exc = e.last_attempt.exception()
+        if isinstance(last_exc, httpx.HTTPStatusError) and last_exc.response.status_code == 403:
+            try:
+                html = await fetch_with_playwright(url)
+            except Exception as e2:
+                return {"error": f"Playwright fallback failed: {e2}", "url": url}
+        else:
+            return {
+                "error": f"Fetch failed after retries: {type(last_exc).__name__}: {last_exc}",
+                "url": url,
+            }
+
+    except httpx.HTTPStatusError as e:
+        # (Non-retry path, just in case)
+        if e.response.status_code == 403:
+            try:
+                html = await fetch_with_playwright(url)
+            except Exception as e2:
+                return {"error": f"Playwright fallback failed: {e2}", "url": url}
+        else:
+            return {"error": f"HTTP {e.response.status_code}: {e.response.reason_phrase}", "url": url}
+
+    except Exception as e:
+        return {"error": f"Unexpected error fetching {url}: {e}"}
 
     def _parse_html(html: str) -> Dict[str, Any]:
-        art = Article(url)
+        result = extract_with_selectolax(url, html)
+        if result is not None:
+            return result
+
+        # Fall back to newspaper's heuristics for pages without the usual markup
+        art = Article(url, config=NEWSPAPER_CONFIG)
         art.set_html(html)
         art.parse()
         # try:
@@ -110,7 +268,7 @@ async def scrape_article(url: str) -> Dict[str, Any]:
 
         text = str(art.text or "").strip()
 
-        result = ScraperResponse(
+        return ScraperResponse(
             title=art.title,
             authors=art.authors,
             publication=art.source_url or None,
@@ -118,7 +276,4 @@ async def scrape_article(url: str) -> Dict[str, Any]:
             text=text,
         )
 
-        return result.model_dump()
-
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, _parse_html, html)
+    return await asyncio.to_thread(_parse_html, html)
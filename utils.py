@@ -1,6 +1,53 @@
-import json, re
-from typing import Any
-from urllib.parse import urlparse
+import json, re, orjson, hashlib
+from typing import Any, Optional
+from urllib.parse import urlparse, urlunparse
+
+# Query parameters that only track the referrer and never change the article
+TRACKING_PARAMS = {"fbclid", "gclid", "dclid", "msclkid", "igshid", "mc_cid", "mc_eid", "ocid", "cmpid", "smid"}
+
+# Compiled once at import; these run on every LLM response and request URL
+FENCE_OPEN = re.compile(r"^```(?:json)?")
+FENCE_CLOSE = re.compile(r"```$")
+DATE_PATH = re.compile(r"/\d{4}/\d{1,2}/\d{1,2}/")
+# Matched anywhere in the path (e.g. "/us-politics-live/"), not only as whole segments
+ARTICLE_WORDS = re.compile("article|news|story|posts|politics|world|economy|health")
+WHITESPACE = re.compile(r"\s+")
+
+def dumps_pretty(obj: Any) -> str:
+    """Serialize to indented JSON text (non-ASCII kept as-is) using orjson."""
+    return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+
+def find_json_span(text: str, openers: str = "{[") -> Optional[str]:
+    """
+    Return the first balanced JSON object/array in text, or None.
+    A single bracket-counting pass that skips over string literals, so it stays
+    linear on malformed output and stops at the matching close of nested objects.
+    """
+    starts = [i for i in (text.find(c) for c in openers) if i != -1]
+    if not starts:
+        return None
+    start = min(starts)
+
+    depth = 0
+    in_string = escaped = False
+    for i in range(start, len(text)):
+        c = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in "{[":
+            depth += 1
+        elif c in "}]":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    return None
 
 def clean_llm_json(text: str):
     """
@@ -11,32 +58,42 @@ def clean_llm_json(text: str):
     if not text:
         return {}
 
+    # Already structured (e.g. a parsed SDK response): nothing to clean
+    if isinstance(text, (dict, list)):
+        return text
+    if hasattr(text, "model_dump"):
+        return text.model_dump()
+    if isinstance(text, bytes):
+        text = text.decode()
+
     # Trim whitespace and remove common formatting wrappers
     text = text.strip()
-    text = re.sub(r"^```(?:json)?", "", text)
-    text = re.sub(r"```$", "", text)
-    text = text.strip().strip('"').strip("'")
+    if "```" in text:
+        text = FENCE_OPEN.sub("", text)
+        text = FENCE_CLOSE.sub("", text)
+        text = text.strip()
+    text = text.strip('"').strip("'")
 
     # Try parsing directly
     try:
-        return json.loads(text)
-    except json.JSONDecodeError:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
         pass
 
     # Try if it's double-encoded (stringified JSON inside a JSON string)
     try:
-        parsed = json.loads(json.loads(text))
+        parsed = orjson.loads(orjson.loads(text))
         return parsed
     except Exception:
         pass
 
-    # Regex fallback to extract first valid JSON array/object
-    match = re.search(r"(\{[\s\S]*\}|\[[\s\S]*\])", text)
-    if match:
-        candidate = match.group(1)
+    # Fallback: extract the first JSON array/object embedded in the text
+    candidate = find_json_span(text)
+    if candidate:
         try:
-            return json.loads(candidate)
+            return orjson.loads(candidate)
         except Exception:
+            # Single-quote repair stays on stdlib json, like extract_json_from_text
             try:
                 return json.loads(candidate.replace("'", '"'))
             except Exception:
@@ -74,12 +131,11 @@ def normalize_evaluation(parsed: dict) -> dict:
     }
 
 def extract_json_from_text(text: str) -> Any:
-    match = re.search(r'\{[\s\S]*\}', text)
-    if not match:
+    candidate = find_json_span(text, "{")
+    if not candidate:
         return None
-    candidate = match.group(0)
     try:
-        return json.loads(candidate)
+        return orjson.loads(candidate)
     except Exception:
         try:
             return json.loads(candidate.replace("'", '"'))
@@ -95,15 +151,38 @@ def looks_like_article_url(url: str) -> bool:
         return False
 
     # Common article URL patterns
-    if re.search(r"/\d{4}/\d{1,2}/\d{1,2}/", path):
+    if DATE_PATH.search(path):
         return True
-    if any(seg in path for seg in ["article", "news", "story", "posts", "politics", "world", "economy", "health"]):
+    if path.endswith((".html", ".htm")):
         return True
-    if path.endswith(".html") or path.endswith(".htm"):
+    if ARTICLE_WORDS.search(path):
         return True
 
     return False
 
+def is_tracking_param(pair: str) -> bool:
+    name = pair.split("=", 1)[0].lower()
+    return name.startswith("utm_") or name in TRACKING_PARAMS
+
+def canonicalize_url(url: str) -> str:
+    """
+    Cache key for a URL: lowercase scheme and host, drop the fragment and tracking query params.
+    Every other query pair is kept byte-for-byte, in order.
+    """
+    parsed = urlparse(url)
+    userinfo, at, host = parsed.netloc.rpartition("@")
+    return urlunparse(parsed._replace(
+        scheme=parsed.scheme.lower(),
+        netloc=userinfo + at + host.lower(),
+        query="&".join(pair for pair in parsed.query.split("&") if pair and not is_tracking_param(pair)),
+        fragment="",
+    ))
+
+def content_hash(text: str) -> str:
+    """Hash article text with whitespace and case normalized, so mirrors of one article match."""
+    normalized = WHITESPACE.sub(" ", text).strip().lower()
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
 def sse_event(event: str, data):
     """Format a dict or string as an SSE event (robust JSON handling)."""
     def default(o):
@@ -115,5 +194,5 @@ def sse_event(event: str, data):
         return str(o)
 
     if not isinstance(data, str):
-        data = json.dumps(data, ensure_ascii=False, default=default)
+        data = orjson.dumps(data, default=default, option=orjson.OPT_NON_STR_KEYS).decode()
     return f"event: {event}\ndata: {data}\n\n"
\ No newline at end of file